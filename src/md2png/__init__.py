@@ -1,14 +1,39 @@
-import re
 import sys
 
+from collections import OrderedDict
+
 import markdown
 
 from PIL import Image, ImageDraw, ImageFont
 
-from functools import reduce
+from functools import lru_cache
 
 BULLET_DIAMETER = 4
-IMAGE_BLOCK_HEIGHT = 1000
+MASK_CACHE_SIZE = 2048
+
+@lru_cache(maxsize=128)
+def _load_font(path, size):
+    """
+    Loads a truetype font, sharing the instance (and its warm glyph cache)
+    between renders.
+    """
+    return ImageFont.truetype(path, size)
+
+@lru_cache(maxsize=128)
+def _line_height(font):
+    """
+    Returns the height of a line of text in font, including descenders.
+    """
+    return font.getbbox("Mg")[3]
+
+@lru_cache(maxsize=4096)
+def _text_width(text, font):
+    """
+    Returns the advance width of text in font.  This skips the full layout
+    needed for a bounding box.  Fonts come from _load_font, so they hash by
+    identity and make a stable key.
+    """
+    return font.getlength(text)
 
 class ImageExtension(markdown.Extension):
     def __init__(self, width_spec, config):
@@ -28,17 +53,50 @@ class ImageExtension(markdown.Extension):
 
 class ImageTreeprocessor(markdown.treeprocessors.Treeprocessor):
     """
-    Recusively walks the parsed markdown and renders to an image.  Uses chunks
-    of IMAGE_BLOCK_HEIGHT to render parts of the markdown incrementally (without
-    pre-measuring) and assembles the chunks at the end. 
+    Walks the parsed markdown and lays it out, recording draw operations at
+    their final offsets.  Once the total height is known a single
+    image is allocated and the operations are replayed onto it.
     """
 
+    # Layout state is read on every laid out line, so keep it in slots rather
+    # than the instance dict
+    __slots__ = (
+        "bold_font",
+        "code_font",
+        "config",
+        "default_font",
+        "draw_ops",
+        "end_x",
+        "h1_font",
+        "h2_font",
+        "h3_font",
+        "h4_font",
+        "h5_font",
+        "h6_font",
+        "image_width",
+        "image_x",
+        "in_pre",
+        "indent",
+        "italics_font",
+        "line_height",
+        "links",
+        "list_item_nums",
+        "list_types",
+        "mask_cache",
+        "next_spec_y",
+        "start_x",
+        "width_spec",
+        "width_spec_index",
+        "y",
+    )
+
     def __init__(self, width_spec, config={}):
-        # List of (Image, height) to be merged for the result
-        self.image = None
-        self.image_draw = None
+        # List of (op name, args, kwargs) to replay on the result
+        self.draw_ops = []
+        # LRU of (font, text) -> (pre-rendered "L" mask, offset) for words and
+        # monospace code glyphs
+        self.mask_cache = OrderedDict()
         self.image_x = 0
-        self.image_y = 0
         self.indent = 0
         self.links = []
 
@@ -46,10 +104,10 @@ class ImageTreeprocessor(markdown.treeprocessors.Treeprocessor):
         self.list_types = []
         self.list_item_nums = []
         self.y = 0
-        self.image_width = max(width_spec, key=lambda x: x[2])[2]
-        self.images = []
+        self.image_width = max(w for (_, _, w) in width_spec)
         self.line_height = 0
-        self.in_pre = False
+        # Depth of nested <pre> elements
+        self.in_pre = 0
 
         self.config = {
             "bold_font_path": "/usr/share/fonts/truetype/freefont/FreeSansBold.ttf",
@@ -71,320 +129,367 @@ class ImageTreeprocessor(markdown.treeprocessors.Treeprocessor):
         }
         self.config.update(config)
 
-        # TODO: Make this configurable
-        font_size = self.config["font_size"]
-        default_font_path = self.config["default_font_path"]
-        self.default_font = ImageFont.truetype(default_font_path, font_size)
-        self.bold_font = ImageFont.truetype(self.config["bold_font_path"], font_size)
-        self.code_font = ImageFont.truetype(self.config["code_font_path"], self.config["code_font_size"])
-        self.h1_font = ImageFont.truetype(self.config["default_font_path"], font_size * 3)
-        self.h2_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 2.5))
-        self.h3_font = ImageFont.truetype(self.config["default_font_path"], font_size * 2)
-        self.h4_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1.75))
-        self.h5_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1.5))
-        self.h6_font = ImageFont.truetype(self.config["default_font_path"], int(font_size * 1.25))
-        self.italics_font = ImageFont.truetype(self.config["italics_font_path"], font_size)
-
         self.width_spec = width_spec
         self.width_spec.sort()
         self.width_spec_index = -1
+        # y-offset of the next width spec, so the common case is one compare
+        self.next_spec_y = self.width_spec[0][0]
         self.apply_width_spec()
 
-    def apply_width_spec(self, h=0):
-        if self.width_spec_index + 1 < len(self.width_spec):
-            if self.width_spec[self.width_spec_index + 1][0] <= self.y + h:
-                self.width_spec_index += 1
-                self.start_x = self.width_spec[self.width_spec_index][1]
-                self.end_x = self.start_x + self.width_spec[self.width_spec_index][2]
-
-    def compact_whitespace(self, text):
-        return re.sub('\s+', ' ', text)
-
-    def ensure_image(self, h):
-        self.apply_width_spec(h)
-
-        if self.image_y + h > self.image.size[1]:
-            if self.image_y == 0:
-                print("Image block size too small!  Results will be cropped...")
-                return
-
-            self.new_image_block()
+    # Where each font attribute is loaded from: (path key, size key, scale)
+    # TODO: Make the header sizes configurable
+    _FONTS = {
+        "bold_font": ("bold_font_path", "font_size", 1),
+        "code_font": ("code_font_path", "code_font_size", 1),
+        "default_font": ("default_font_path", "font_size", 1),
+        "h1_font": ("default_font_path", "font_size", 3),
+        "h2_font": ("default_font_path", "font_size", 2.5),
+        "h3_font": ("default_font_path", "font_size", 2),
+        "h4_font": ("default_font_path", "font_size", 1.75),
+        "h5_font": ("default_font_path", "font_size", 1.5),
+        "h6_font": ("default_font_path", "font_size", 1.25),
+        "italics_font": ("italics_font_path", "font_size", 1),
+    }
+
+    def __getattr__(self, name):
+        # Only called while a font slot is still empty.  Fonts are loaded on
+        # first use and stored in their slot, so documents without headers,
+        # emphasis or code never load those faces.
+        if name not in self._FONTS:
+            raise AttributeError(name)
+
+        (path_key, size_key, scale) = self._FONTS[name]
+        font = _load_font(self.config[path_key], int(self.config[size_key] * scale))
+        setattr(self, name, font)
+        return font
 
-        return self.image_draw
-
-    def get_image(self):
-        # Add the last used image if necessary
-        self.save_image_block()
-
-        height = reduce(lambda x, y: x + y[1], self.images, 0)
-        final = Image.new("RGBA", (self.image_width, height))
-        y = 0
-        for img in self.images:
-            final.paste(img[0], (0, y))
-            y += img[1]
-
-        return final
-
-    def get_links(self):
-        return self.links
+    def apply_width_spec(self, h=0):
+        if self.y + h >= self.next_spec_y:
+            self.width_spec_index += 1
+            (_, self.start_x, width) = self.width_spec[self.width_spec_index]
+            self.end_x = self.start_x + width
 
-    def handle_a(self, node):
-        text = node.text
+            if self.width_spec_index + 1 < len(self.width_spec):
+                self.next_spec_y = self.width_spec[self.width_spec_index + 1][0]
+            else:
+                self.next_spec_y = float("inf")
 
+    def compact_whitespace(self, text):
+        # Same as re.sub('\s+', ' ', text), but str.split() is much cheaper.
+        # Leading and trailing space separate inline elements, so keep them.
+        words = text.split()
+        if not words:
+            return " " if text else text
+
+        compact = " ".join(words)
+        if text[0].isspace():
+            compact = " " + compact
+        if text[-1].isspace():
+            compact += " "
+        return compact
+
+    def draw(self, op, *args, **kwargs):
+        self.draw_ops.append((op, args, kwargs))
+
+    def enter_a(self, node):
         if "href" in node.attrib:
-            blocks = self.render_text(node.text, self.config["link_color"], False)
+            blocks = self.render_text(node.text, self.config["link_color"], False,
+                                      emit_blocks=True)
             self.links.append((node.attrib["href"], blocks))
         else:
             self.render_text(node.text, self.config["color"], False)
-        self.handle_children(node)
-        self.render_text(node.tail, self.config["color"], False)
 
-    def handle_blockquote(self, node):
-        indent = self.config["blockquote_indent"]
-        self.indent += indent
+    def enter_blockquote(self, node):
+        self.indent += self.config["blockquote_indent"]
         self.newline()
-        self.handle_children(node)
-        self.indent -= indent
-        self.newline()
-
-    def handle_code(self, node):
-        text = node.text
 
+    def enter_code(self, node):
         self.render_text(node.text, self.config["color"], False, font=self.code_font)
-        self.handle_children(node)
-        self.render_text(node.tail, self.config["color"], False)
-
-    def handle_children(self, node):
-        if len(node) > 0:
-            for child in node:
-                self.handle_node(child)
-
-    def handle_div(self, node):
-        if self.image_x > self.start_x + self.indent:
-            self.newline()
-
-        self.handle_children(node)
 
+    def enter_div(self, node):
         if self.image_x > self.start_x + self.indent:
             self.newline()
 
-    def handle_em(self, node):
-        text = node.text
-
+    def enter_em(self, node):
         self.render_text(node.text, self.config["color"], False, font=self.italics_font)
-        self.handle_children(node)
-        self.render_text(node.tail, self.config["color"], False)
-
-    def handle_h(self, node):
-        text = node.text
 
+    def enter_h(self, node):
         font = getattr(self, node.tag + "_font")
         self.render_text(node.text, self.config["color"], True, font=font)
         # TODO: Make this HR padding-bottom configurable
         self.newline()
 
-    def handle_hr(self, node):
+    def enter_hr(self, node):
         self.newline()
         h = self.config["margin_bottom"]
         horizontal_padding = self.config["hr_padding"]
-        self.image_draw.line((self.start_x + horizontal_padding, self.image_y + h / 2,
-                              self.end_x - horizontal_padding, self.image_y + h / 2), fill=self.config["hr_color"])
+        self.draw("line", (self.start_x + horizontal_padding, self.y + h / 2,
+                           self.end_x - horizontal_padding, self.y + h / 2), fill=self.config["hr_color"])
         self.newline(h)
 
-    def handle_li(self, node):
+    def enter_li(self, node):
         list_type = self.list_types[-1]
         if list_type == "unordered":
             # Draw the bullet
-            (w, h) = self.image_draw.textsize("E", font=self.default_font)
-            draw = self.ensure_image(h)
+            h = _line_height(self.default_font)
+            self.apply_width_spec(h)
 
             x = self.image_x - BULLET_DIAMETER - self.config["bullet_outdent"]
-            y = self.image_y + (h - BULLET_DIAMETER) / 2
-            draw.ellipse((x, y,
-                          x + BULLET_DIAMETER,
-                          y + BULLET_DIAMETER),
-                          outline=self.config["color"],
-                          fill=self.config["color"])
+            y = self.y + (h - BULLET_DIAMETER) / 2
+            self.draw("ellipse", (x, y,
+                                  x + BULLET_DIAMETER,
+                                  y + BULLET_DIAMETER),
+                      outline=self.config["color"],
+                      fill=self.config["color"])
 
             self.render_text(node.text, self.config["color"], True)
-            self.handle_children(node)
         elif list_type == "ordered":
             # Draw the number
             current_number = "%d" % self.list_item_nums[-1]
-            (w, h) = self.image_draw.textsize(current_number, font=self.default_font)
-            draw = self.ensure_image(h)
+            w = _text_width(current_number, self.default_font)
+            h = _line_height(self.default_font)
+            self.apply_width_spec(h)
 
             x = self.image_x - w - self.config["bullet_outdent"]
-            draw.text((x, self.image_y), current_number + ".",
+            self.draw("text", (x, self.y), current_number + ".",
                       font=self.default_font,
                       fill=self.config["color"])
 
             self.list_item_nums[-1] += 1
 
             self.render_text(node.text, self.config["color"], True)
-            self.handle_children(node)
-
-        # REVIEW: Ignore tail text on li items b/c.  Is this okay?
-        # self.render_text(node.tail, self.config["color"], True)
-        self.newline(self.config["list_item_margin_bottom"])
 
-    def handle_node(self, node):
-        # print "Handling %s" % node.tag
-        handlers = {
-            "a": self.handle_a,
-            "code": self.handle_code,
-            "blockquote": self.handle_blockquote,
-            "em": self.handle_em,
-            "div": self.handle_div,
-            "h1": self.handle_h,
-            "h2": self.handle_h,
-            "h3": self.handle_h,
-            "h4": self.handle_h,
-            "h5": self.handle_h,
-            "h6": self.handle_h,
-            "hr": self.handle_hr,
-            "li": self.handle_li,
-            "ol": self.handle_ol,
-            "p": self.handle_p,
-            "pre": self.handle_pre,
-            "strong": self.handle_strong,
-            "ul": self.handle_ul,
-        }
-        handlers.get(node.tag, self.handle_unknown)(node)
-        # print "Done with %s" % node.tag
-
-    def handle_ol(self, node):
-        indent = self.config["list_indent"]
-        self.indent += indent
+    def enter_ol(self, node):
+        self.indent += self.config["list_indent"]
         self.newline()
 
         self.list_types.append("ordered")
         self.list_item_nums.append(1)
-        self.handle_children(node)
-        self.list_item_nums = self.list_item_nums[:-1]
-        self.list_types = self.list_types[:-1]
-
-        self.indent -= indent
-        self.newline()
 
-    def handle_p(self, node):
+    def enter_p(self, node):
         self.render_text(node.text, self.config["color"], False)
-        self.handle_children(node)
 
-        self.render_text(node.tail, self.config["color"], True)
-        self.newline(self.config["margin_bottom"])
+    def enter_pre(self, node):
+        self.in_pre += 1
 
-    def handle_pre(self, node):
-        old_in_pre = self.in_pre
-        self.in_pre = True
-
-        indent = self.config["code_indent"]
-        self.indent += indent
+        self.indent += self.config["code_indent"]
         self.newline()
 
-        self.handle_children(node)
+    def enter_strong(self, node):
+        self.render_text(node.text, self.config["color"], False, font=self.bold_font)
 
-        self.indent -= indent
+    def enter_ul(self, node):
+        self.indent += self.config["list_indent"]
         self.newline()
 
-        self.in_pre = old_in_pre
+        self.list_types.append("unordered")
 
-    def handle_strong(self, node):
-        text = node.text
+    def enter_unknown(self, node):
+        print("Unknown tag: %s" % node.tag)
 
-        self.render_text(node.text, self.config["color"], False, font=self.bold_font)
-        self.handle_children(node)
+    def exit_blockquote(self, node):
+        self.indent -= self.config["blockquote_indent"]
+        self.newline()
+
+    def exit_div(self, node):
+        if self.image_x > self.start_x + self.indent:
+            self.newline()
+
+    def exit_inline(self, node):
         self.render_text(node.tail, self.config["color"], False)
 
-    def handle_ul(self, node):
-        indent = self.config["list_indent"]
-        self.indent += indent
+    def exit_li(self, node):
+        # REVIEW: Ignore tail text on li items b/c.  Is this okay?
+        # self.render_text(node.tail, self.config["color"], True)
+        self.newline(self.config["list_item_margin_bottom"])
+
+    def exit_ol(self, node):
+        self.list_item_nums.pop()
+        self.list_types.pop()
+
+        self.indent -= self.config["list_indent"]
         self.newline()
 
-        self.list_types.append("unordered")
-        self.handle_children(node)
-        self.list_types = self.list_types[:-1]
+    def exit_p(self, node):
+        self.render_text(node.tail, self.config["color"], True)
+        self.newline(self.config["margin_bottom"])
 
-        self.indent -= indent
+    def exit_pre(self, node):
+        self.indent -= self.config["code_indent"]
         self.newline()
 
-    def handle_unknown(self, node):
-        print("Unknown tag: %s" % node.tag)
-        self.handle_children(node)
+        self.in_pre -= 1
+
+    def exit_ul(self, node):
+        self.list_types.pop()
+
+        self.indent -= self.config["list_indent"]
+        self.newline()
+
+    def get_image(self):
+        final = Image.new("RGBA", (self.image_width, self.y))
+        draw = ImageDraw.Draw(final)
+        for (op, args, kwargs) in self.draw_ops:
+            if op == "mask":
+                self.paste_mask(final, *args, **kwargs)
+            elif op == "glyphs":
+                self.paste_glyphs(final, *args, **kwargs)
+            else:
+                getattr(draw, op)(*args, **kwargs)
+
+        return final
+
+    def get_links(self):
+        return self.links
+
+    def get_mask(self, text, font):
+        """
+        Returns (mask, offset) for text, where offset is the position of the
+        mask relative to the text origin.  The mask covers the full bounding
+        box, including any negative bearing.
+        """
+        key = (font, text)
+        cached = self.mask_cache.get(key)
+        if cached is None:
+            (left, top, right, bottom) = font.getbbox(text)
+            mask = Image.new("L", (right - left, bottom - top))
+            ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+            cached = (mask, (left, top))
+            self.mask_cache[key] = cached
+            if len(self.mask_cache) > MASK_CACHE_SIZE:
+                self.mask_cache.popitem(last=False)
+        else:
+            self.mask_cache.move_to_end(key)
+
+        return cached
 
     def newline(self, h= -1):
         if h == -1:
             h = self.line_height
 
-        self.image_y += h
         self.y += h
         self.image_x = self.start_x + self.indent
 
         self.line_height = 0
 
-    def new_image_block(self):
-        self.save_image_block()
-
-        self.image = Image.new("RGBA", (self.image_width, IMAGE_BLOCK_HEIGHT))
-        self.image_draw = ImageDraw.Draw(self.image)
-        self.image_y = 0
-
-    def render_text(self, text, color, end_block=False, font=None):
+    def paste_glyphs(self, image, xy, text, font, fill, line_height):
+        """
+        Draws monospace text one cached glyph mask at a time, so each
+        character is only rasterized once per font.
+        """
+        (x, y) = xy
+        advance = _text_width("M", font)
+        for ch in text:
+            if ch == "\n":
+                x = xy[0]
+                y += line_height
+                continue
+
+            if not ch.isspace():
+                self.paste_mask(image, (x, y), ch, font, fill)
+            x += advance
+
+    def paste_mask(self, image, xy, text, font, fill):
+        """
+        Draws text by pasting fill through its cached mask, so repeated words
+        and glyphs are only rasterized once per font.
+        """
+        (mask, (left, top)) = self.get_mask(text, font)
+        (w, h) = mask.size
+        if w > 0 and h > 0:
+            x = int(round(xy[0])) + left
+            y = int(round(xy[1])) + top
+            image.paste(fill, (x, y, x + w, y + h), mask)
+
+    def render_text(self, text, color, end_block=False, font=None, emit_blocks=False):
+        """
+        Lays out text at the current position.  With emit_blocks, returns the
+        list of (x, y, w, h) rectangles covered by the text.
+        """
         if text is None:
             return
 
-        blocks = []
+        blocks = [] if emit_blocks else None
 
         if font is None:
             font = self.default_font
 
         if self.in_pre:
+            # Code lines never wrap, so lay the block out with a uniform line
+            # height and draw it with a single op
             lines = text.split("\n")
-            for line in lines:
-                (w, h) = self.image_draw.textsize(line, font=font)
-                draw = self.ensure_image(h)
-
-                draw.text((self.image_x, self.image_y), line, font=font, fill=color)
-                blocks.append((self.image_x, self.y, w, h))
+            # A trailing newline ends the last line rather than starting a new one
+            if len(lines) > 1 and not lines[-1]:
+                lines.pop()
+            h = _line_height(font)
+            self.apply_width_spec(h)
+
+            batches = [(0, len(lines))]
+            if self.y + h * len(lines) >= self.next_spec_y:
+                # A width spec boundary falls inside the block, so fall back
+                # to drawing it line by line
+                batches = [(i, i + 1) for i in range(len(lines))]
+
+            for (start, end) in batches:
+                self.apply_width_spec(h)
+
+                batch = "\n".join(lines[start:end])
+                if font is self.code_font:
+                    self.draw("glyphs", (self.image_x, self.y), batch, font, color, h)
+                else:
+                    spacing = h - font.getbbox("A")[3]
+                    self.draw("multiline_text", (self.image_x, self.y), batch,
+                              font=font, fill=color, spacing=spacing)
+                if emit_blocks:
+                    for i in range(start, end):
+                        blocks.append((self.image_x, self.y + (i - start) * h,
+                                       int(round(_text_width(lines[i], font))), h))
 
                 self.line_height = max(h, self.line_height)
-                self.newline()
+                self.newline(self.line_height + h * (end - start - 1))
         else:
             text = self.compact_whitespace(text)
             start_index = 0
             end_index = 0
-            draw = self.image_draw
 
+            # Measure every word and the space once up front so fitting a line
+            # is a scan over the widths.  The line height doesn't depend on the
+            # words, so it is only looked up once.
             parts = text.split(" ")
+            word_widths = [_text_width(word, font) for word in parts]
+            space_w = _text_width(" ", font)
+            h = _line_height(font)
             while end_index < len(parts):
-                w = 0
+                # Always take the first word, even when it can't fit on this
+                # line, then add words while they fit
+                avail_w = self.end_x - self.image_x
+                line_w = word_widths[start_index]
+                end_index = start_index + 1
                 while end_index < len(parts):
-                    (w, h) = draw.textsize(" ".join(parts[start_index:end_index + 1]),
-                                           font=font)
-                    if self.image_x + w > self.end_x:
+                    w = line_w + space_w + word_widths[end_index]
+                    if w > avail_w:
                         break
 
+                    line_w = w
                     end_index += 1
 
-                # In the case that we can't fit a single word on this line
-                # just render the first word
-                if start_index == end_index:
-                    end_index = start_index + 1
+                # Advance widths can be fractional; keep positions whole pixels
+                line_w = int(round(line_w))
 
-                text_frag = " ".join(parts[start_index:end_index])
-                draw = self.ensure_image(h)
+                self.apply_width_spec(h)
 
                 self.line_height = max(h, self.line_height)
 
-                # print "Rendering %s" % text_frag
-                draw.text((self.image_x, self.image_y),
-                          text_frag,
-                          font=font, fill=color)
+                # Draw word by word at the widths used for layout.  Words
+                # repeat far more than whole lines, so their masks are reused.
+                x = self.image_x
+                for i in range(start_index, end_index):
+                    if parts[i]:
+                        self.draw("mask", (x, self.y), parts[i], font, color)
+                    x += word_widths[i] + space_w
 
-                # Get a real measurement segment 
-                (w, h) = draw.textsize(text_frag,
-                                       font=font)
-                blocks.append((self.image_x, self.y, w, h))
+                if emit_blocks:
+                    blocks.append((self.image_x, self.y, line_w, h))
 
                 if end_index < len(parts):
                     self.newline()
@@ -394,23 +499,58 @@ class ImageTreeprocessor(markdown.treeprocessors.Treeprocessor):
                         self.newline()
                     # Otherwise, leave X at the end of the last word
                     else:
-                        self.image_x += w
+                        self.image_x += line_w
 
                 start_index = end_index
 
         return blocks
 
-    def save_image_block(self):
-        if self.image is not None:
-            self.images.append((self.image, self.image_y))
-            del self.image_draw
-
     def run(self, root):
-        self.new_image_block()
-        self.handle_node(root)
+        # Walk the tree with an explicit stack instead of recursing.  Entries
+        # are (exit handler, node), with no exit handler for nodes that have
+        # not been entered yet.
+        stack = [(None, root)]
+        while stack:
+            (leave, node) = stack.pop()
+            if leave is not None:
+                leave(self, node)
+                continue
+
+            (enter, leave) = self._HANDLERS.get(node.tag, self._UNKNOWN_HANDLERS)
+            enter(self, node)
+            if leave is not None:
+                stack.append((leave, node))
+            if node.tag not in self._CHILDLESS_TAGS:
+                stack.extend((None, child) for child in reversed(node))
 
         return root
 
+    # Tag to (enter, exit) handlers, built once rather than on every node
+    _HANDLERS = {
+        "a": (enter_a, exit_inline),
+        "code": (enter_code, exit_inline),
+        "blockquote": (enter_blockquote, exit_blockquote),
+        "em": (enter_em, exit_inline),
+        "div": (enter_div, exit_div),
+        "h1": (enter_h, None),
+        "h2": (enter_h, None),
+        "h3": (enter_h, None),
+        "h4": (enter_h, None),
+        "h5": (enter_h, None),
+        "h6": (enter_h, None),
+        "hr": (enter_hr, None),
+        "li": (enter_li, exit_li),
+        "ol": (enter_ol, exit_ol),
+        "p": (enter_p, exit_p),
+        "pre": (enter_pre, exit_pre),
+        "strong": (enter_strong, exit_inline),
+        "ul": (enter_ul, exit_ul),
+    }
+    _UNKNOWN_HANDLERS = (enter_unknown, None)
+
+    # Headers render their text only and skip any children
+    _CHILDLESS_TAGS = frozenset(("h1", "h2", "h3", "h4", "h5", "h6"))
+
 def md2png(md_str, width_spec, config):
     """
     md_str: Valid markdown in a string